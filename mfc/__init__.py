@@ -4,7 +4,21 @@ Python driver for MKS flow controllers.
 Distributed under the GNU General Public License v2
 Copyright (C) 2019 NuMat Technologies
 """
-from mfc.driver import FlowController
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from mfc.driver import FlowController, poll_all  # noqa: F401
+
+__all__ = ['FlowController', 'poll_all', 'command_line']
+
+
+def __getattr__(name):
+    """Import the driver lazily, so `mfc --help` doesn't load aiohttp."""
+    if name in ('driver', 'FlowController', 'poll_all'):
+        driver = importlib.import_module('mfc.driver')
+        return driver if name == 'driver' else getattr(driver, name)
+    raise AttributeError(f"module 'mfc' has no attribute '{name}'")
 
 
 def command_line():
@@ -17,17 +31,24 @@ def command_line():
 
     parser = argparse.ArgumentParser(description="Control an MKS MFC from "
                                      "the command line.")
-    parser.add_argument('address', help="The IP address of the MFC")
+    parser.add_argument('address', nargs='+', help="The IP address of the MFC. "
+                        "Multiple addresses are polled concurrently.")
     parser.add_argument('--set', '-s', default=None, type=float, help="Sets "
                         "the setpoint flow of the mass flow controller, in "
                         "units specified in the manual (likely sccm).")
     parser.add_argument('--set-gas', '-g', default=None, help="Sets the mass "
                         "flow controller gas type, e.g. 'CO2', 'N2'.")
     args = parser.parse_args()
+    if len(args.address) > 1 and (args.set is not None or args.set_gas):
+        parser.error("--set and --set-gas only support a single address.")
 
     async def get():
+        from mfc.driver import FlowController, poll_all
         try:
-            async with FlowController(args.address) as fc:
+            if len(args.address) > 1:
+                print(json.dumps(await poll_all(args.address), indent=4, sort_keys=True))
+                return
+            async with FlowController(args.address[0]) as fc:
                 if args.set_gas:
                     await fc.set_gas(args.set_gas)
                 if args.set is not None:
@@ -39,9 +60,11 @@ def command_line():
         except Exception as e:
             sys.stderr.write(f'{red}{e}{reset}\n')
 
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(get())
-    loop.close()
+    try:
+        from uvloop import run
+    except ImportError:
+        run = asyncio.run
+    run(get())
 
 
 if __name__ == '__main__':
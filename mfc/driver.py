@@ -4,13 +4,25 @@ Python driver for MKS flow controllers.
 Distributed under the GNU General Public License v2
 Copyright (C) 2019 NuMat Technologies
 """
+import asyncio
+import random
+import re
+import time
 from binascii import unhexlify
-from struct import unpack
+from struct import Struct
 from urllib.parse import quote_plus
-from xml.etree import ElementTree
 
 import aiohttp
 
+_FLOAT = Struct('>f')
+_XML_HEADERS = {'Content-Type': 'text/xml', 'Accept-Encoding': 'identity'}
+_LOGIN_FORM = 'CONFIG_PASSWORD'
+_FORM_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+_POLL_VALUE_RE = re.compile(rb'<V\b[^>]*\bName="([^"]+)"[^>]*>\s*0[xX]([0-9A-Fa-f]{8})\s*</V>')
+_SELECTED_GAS_RE = re.compile(rb'device_html\.selected_gas[^\n]*?: ([^"\n;]+)')
+_FULL_SCALE_RE = re.compile(rb'device_html\.full_scale_amount\s*=\s*([-+.\deE]+)')
+_GAS_INSTANCE_RE = re.compile(rb'^[^"\n]*"\s*([^"\n]*?: ([^"\n]*?))\s*"', re.MULTILINE)
+
 
 class FlowController(object):
     """Driver for MKS mass flow controllers."""
@@ -21,7 +33,9 @@ class FlowController(object):
         'temperature': 'EVID_3'  # °C
     }
 
-    def __init__(self, address: str, timeout: float = 1.0, password: str = 'config'):
+    def __init__(self, address: str, timeout: float = 1.0, password: str = 'config',
+                 session: aiohttp.ClientSession = None, cache_ttl: float = 0.05,
+                 retries: int = 2):
         """Initialize device.
 
         Note that this constructor does not not connect. This will happen
@@ -30,19 +44,39 @@ class FlowController(object):
 
         Args:
             address: The IP address of the device, as a string.
-            timeout (optional): Time to wait for a response before throwing
-                a TimeoutError. Default 1s.
+            timeout (optional): Time to wait for each attempt at a response.
+                Default 1s. With retries, an unresponsive device raises a
+                TimeoutError after roughly `(retries + 1) * timeout`.
             password (optional): Password used to access admin settings on the
                 web interface. Default "config".
+            session (optional): An existing aiohttp session to share between
+                controllers. It is not closed on disconnect. By default, each
+                controller opens its own session.
+            cache_ttl (optional): Time, in seconds, for which `get` reuses the
+                last reading instead of polling the device again. Default 50ms.
+            retries (optional): Number of times a request is retried, with a
+                short backoff, after a connection error or timeout. Default 2.
 
         """
-        self.address = f"http://{address.lstrip('http://').rstrip('/')}/"
+        address = re.sub(r'^https?://', '', address, flags=re.IGNORECASE)
+        self.address = f"http://{address.rstrip('/')}/"
         self.session = None
+        self._shared_session = session
         self.Timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
         self.password = password
-        self.analog_setpoint = 0
+        self.cache_ttl = cache_ttl
+        self._cache, self._cache_time = None, 0.0
+        self._inflight = None
+        self._generation = 0
+        self._last_login = None
+        self._login_ttl = 30.0
+        self.analog_setpoint = None
+        self._last_analog_refresh = 0.0
+        self._refreshing_analog = False
+        self._evid_to_key = {v.encode(): k for k, v in self.evids.items()}
         ids = ''.join(f'<V Name="{evid}"/>' for evid in self.evids.values())
-        self.get_request_body = f'<PollRequest>{ids}</PollRequest>'
+        self.get_request_body = f'<PollRequest>{ids}</PollRequest>'.encode()
 
     async def __aenter__(self):
         """Support `async with` by entering a client session."""
@@ -70,31 +104,81 @@ class FlowController(object):
 
         The second gets all configured gas instances. There are some set on
         the device by default, and extras can be configured on the device
-        website. After the driver has these instances, a final request figures
-        out the currently selected gas.
+        website. A final request figures out the currently selected gas.
+
+        These requests are independent, so they are sent concurrently.
+
+        The session keeps a small pool of connections to the device alive
+        between requests, so polling doesn't pay for a new TCP handshake each
+        time. The explicit keep-alive header stops the device's web server
+        from closing a connection after each response.
         """
-        self.session = aiohttp.ClientSession(timeout=self.Timeout)
-        self.is_analog = await self._check_if_analog()
-        self.gases = await self._get_gas_instances()
-        self.selected_gas, self.max_flow = await self._get_selected_gas()
+        if self._shared_session is not None:
+            self.session = self._shared_session
+        else:
+            connector = aiohttp.TCPConnector(limit=4, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.Timeout,
+                                                 headers={'Connection': 'keep-alive'})
+        self.is_analog, self.gases, (self.selected_gas, self.max_flow) = await asyncio.gather(
+            self._check_if_analog(),
+            self._get_gas_instances(),
+            self._get_selected_gas(),
+        )
 
     async def disconnect(self):
-        """Close the underlying session, if it exists."""
+        """Close the underlying session, if it exists and isn't shared."""
         if self.session is not None:
-            await self.session.close()
+            if self.session is not self._shared_session:
+                await self.session.close()
             self.session = None
+            self._last_login = None
+            self._invalidate_cache()
 
     async def get(self):
         """Retrieve the device state.
 
         This is done through ToolWeb, a simple HTTP endpoint that delivers an
         XML response. One quirk - getting data is accomplished by a POST.
+
+        Concurrent calls share a single in-flight request, and a reading
+        younger than `cache_ttl` is returned without polling again. Setting
+        the flow or gas invalidates the cached reading.
+        """
+        if self._cache is not None and time.monotonic() - self._cache_time < self.cache_ttl:
+            return dict(self._cache)
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._poll())
+            self._inflight.add_done_callback(self._clear_inflight)
+        return dict(await asyncio.shield(self._inflight))
+
+    async def _poll(self):
+        """Request the device state, cache it, and handle analog reboots.
+
+        The reading is only cached if no write happened while it was in
+        flight, as it may predate that write.
         """
-        response = await self._request('ToolWeb/Cmd', body=self.get_request_body)
+        generation = self._generation
+        response = await self._request('ToolWeb/Cmd', body=self.get_request_body, raw=True)
         parsed = self._process(response)
-        await self._handle_analog(parsed['setpoint'])
+        if generation == self._generation:
+            self._cache, self._cache_time = parsed, time.monotonic()
+        if self.is_analog:
+            await self._handle_analog(parsed['setpoint'])
         return parsed
 
+    def _clear_inflight(self, future):
+        """Allow the next `get` to poll once the shared request finishes."""
+        if self._inflight is future:
+            self._inflight = None
+        if not future.cancelled():
+            future.exception()  # Mark as retrieved; waiting callers re-raise it.
+
+    def _invalidate_cache(self):
+        """Discard cached and in-flight readings that may predate a write."""
+        self._generation += 1
+        self._cache = None
+        self._inflight = None
+
     async def set(self, setpoint):
         """Set the setpoint flow rate, in sccm.
 
@@ -104,7 +188,8 @@ class FlowController(object):
 
         This also handles analog devices by storing the setpoint in a cached
         variable and ensuring the device is configured to respond to digital
-        setpoints.
+        setpoints. The display is switched to flow alongside, so it doesn't
+        delay the setpoint itself.
 
         Args:
             setpoint: Setpoint flow, as a float, in sccm.
@@ -112,12 +197,13 @@ class FlowController(object):
         """
         if setpoint < 0 or setpoint > self.max_flow:
             raise ValueError(f"Setpoint must be between 0 and {self.max_flow:d} sccm.")
+        self._invalidate_cache()
         if self.is_analog:
             self.analog_setpoint = setpoint
-            await self._enable_digital()
-            await self.set_display('flow')
-        body = f'iobuf.setpoint={setpoint:.2f}&SUBMIT=Submit'
-        await self._request('flow_setpoint_html', body)
+            await asyncio.gather(self._write_setpoint(setpoint), self.set_display('flow'))
+        else:
+            await self._write_setpoint(setpoint)
+        self._invalidate_cache()
 
     async def open(self):
         """Set the flow to its maximum value."""
@@ -140,9 +226,10 @@ class FlowController(object):
         """
         if gas not in self.gases:
             raise ValueError(f"Gas must be in {list(self.gases.keys())}.")
-        await self._login()
+        self._invalidate_cache()
         body = f'device_html.selected_gas={quote_plus(self.gases[gas])}&SUBMIT=Set'
-        await self._request('device_html_selected_gas', body)
+        await self._admin_request('device_html_selected_gas', body)
+        self._invalidate_cache()
         self.selected_gas, self.max_flow = await self._get_selected_gas()
 
     async def set_display(self, mode):
@@ -152,54 +239,67 @@ class FlowController(object):
             mode: One of 'ip', 'flow', or 'temperature'.
 
         """
-        await self._login()
         mode_index = ['ip', 'flow', 'temperature'].index(mode.lower())
         body = f'DISPLAY_MODE={mode_index:d}&SUBMIT=Submit'
-        await self._request('change_display_mode', body)
+        await self._admin_request('change_display_mode', body)
 
     async def _login(self):
-        """Log in to the device. Required for gas and display setting."""
+        """Log in to the device. Required for gas and display setting.
+
+        A successful login is reused for `_login_ttl` seconds, so back-to-back
+        admin operations don't each pay for an extra request.
+        """
+        now = time.monotonic()
+        if self._last_login is not None and now - self._last_login < self._login_ttl:
+            return
         body = f'CONFIG_PASSWORD={self.password}&SUBMIT=Change+Settings'
         await self._request('configure_html_check', body)
+        self._last_login = now
+
+    async def _admin_request(self, endpoint, body):
+        """Send a request that requires a login.
+
+        The device answers an unauthenticated request with its login page and
+        a 200 status, rather than a 401/403. If that happens, the reused
+        login has expired, so log in again and retry once.
+        """
+        await self._login()
+        response = await self._request(endpoint, body)
+        if _LOGIN_FORM in response:
+            self._last_login = None
+            await self._login()
+            response = await self._request(endpoint, body)
+        return response
 
     async def _get_selected_gas(self):
         """Get the current specified gas and max flow rate."""
-        response = await self._request('device_html.js')
-        selected_gas, max_flow = None, None
-        lines = response.split('\n')
-        for line in lines:
-            if 'device_html.selected_gas' in line:
-                selected_gas = line.split(': ')[1].rstrip('";')
-            elif 'device_html.full_scale_amount' in line:
-                max_flow = int(float(line.split('=')[1].rstrip(';')))
+        response = await self._request('device_html.js', raw=True)
+        selected_gas = _SELECTED_GAS_RE.search(response)
+        max_flow = _FULL_SCALE_RE.search(response)
+        selected_gas = selected_gas.group(1).decode() if selected_gas else None
+        max_flow = int(float(max_flow.group(1))) if max_flow else None
         return (selected_gas, max_flow)
 
-    async def _get_gas_instances(self, callback=None, retries=3):
+    async def _get_gas_instances(self):
         """Get the current gas instance configuration."""
-        response = await self._request('gaslist.js')
-        gases = {}
-        lines = response.split('\n')
-        start = lines.index('instancelist = new Array();') + 1
-        for line in lines[start:]:
-            if line:
-                gas_command = line.split('"')[1].rstrip('";').strip()
-                gas_name = gas_command.split(': ')[1]
-                if gas_name != 'NOGAS':
-                    gases[gas_name] = gas_command
-        return gases
+        response = await self._request('gaslist.js', raw=True)
+        start = response.index(b'instancelist = new Array();')
+        return {name.decode(): command.decode() for command, name
+                in _GAS_INSTANCE_RE.findall(response, start)
+                if name != b'NOGAS'}
 
     def _process(self, response):
-        """Convert XML response string into a simplified dictionary.
+        """Convert XML response bytes into a simplified dictionary.
 
         This also adds the max flow rate and selected gas, which are cached
         values from other requests.
+
+        The response is a flat list of `<V Name="EVID_n">0x...</V>` elements,
+        so it is scanned with a regex rather than run through an XML parser.
         """
         state = {'max': self.max_flow, 'gas': self.selected_gas}
-        tree = ElementTree.fromstring(response)
-        for item in tree.findall('V'):
-            evid, value = item.get('Name'), item.text
-            key = next(k for k, v in self.evids.items() if v == evid)
-            state[key] = unpack('!f', unhexlify(value[2:]))[0]
+        for evid, value in _POLL_VALUE_RE.findall(response):
+            state[self._evid_to_key[evid]] = _FLOAT.unpack(unhexlify(value))[0]
         return state
 
     async def _check_if_analog(self):
@@ -209,24 +309,45 @@ class FlowController(object):
         default. This prevents the driver from setting flow rates. We must
         enable digital override on start, and again on every controller reboot.
         """
-        response = await self._request('mfc.js')
-        return ('mfc.sp_adc_enable' in response)
+        response = await self._request('mfc.js', raw=True)
+        return (b'mfc.sp_adc_enable' in response)
 
     async def _handle_analog(self, setpoint):
         """Handle intermittent analog controller reboots.
 
         The analog devices reboot occasionally, setting the flow to zero. If
         this driver detects a reboot, it will set the flow rate to the last
-        set value.
+        set value. Nothing is written until this controller has set a flow
+        itself, so read-only use never changes the device. Refreshes are
+        limited to one per second, and skipped while one is already in
+        flight, so fast polling doesn't flood the device. A reboot also drops
+        the device's login, so any cached login is discarded first.
         """
-        if self.is_analog and abs(setpoint - self.analog_setpoint) > 1e-3:
+        if self.analog_setpoint is None or abs(setpoint - self.analog_setpoint) <= 1e-3:
+            return
+        now = time.monotonic()
+        if self._refreshing_analog or now - self._last_analog_refresh < 1.0:
+            return
+        self._last_analog_refresh = now
+        self._refreshing_analog = True
+        self._last_login = None
+        try:
             await self.set(self.analog_setpoint)
+        finally:
+            self._refreshing_analog = False
 
     async def _enable_digital(self):
         """Enable digital setpoints on analog controllers. Run on start."""
         await self._request('flow_setpoint_html', 'mfc.sp_adc_enable=0')
 
-    async def _request(self, endpoint, body=None):
+    async def _write_setpoint(self, setpoint):
+        """Send the setpoint, enabling digital control first on analog devices."""
+        if self.is_analog:
+            await self._enable_digital()
+        body = f'iobuf.setpoint={setpoint:.2f}&SUBMIT=Submit'
+        await self._request('flow_setpoint_html', body)
+
+    async def _request(self, endpoint, body=None, raw=False):
         """Handle sending an HTTP request.
 
         The headers are important! aiohttp overwrites many Content-Type headers
@@ -240,15 +361,73 @@ class FlowController(object):
         curl defaults to application/x-www-form-urlencoded, which appears to
         work with the mfc.
 
+        Set `raw` to get the response body as bytes, skipping the text decode
+        for responses that are only pattern-matched.
+
+        Connection errors and timeouts are retried up to `self.retries` times
+        with jittered exponential backoff, so a flaky link isn't hammered with
+        requests and controllers sharing a network don't retry in lockstep.
+
         """
         if self.session is None:
             await self.connect()
         url = self.address + endpoint
         method = ('POST' if body else 'GET')
-        headers = {'Content-Type': 'text/xml' if endpoint == 'ToolWeb/Cmd'
-                                   else 'application/x-www-form-urlencoded'}
-        async with self.session.request(method, url, headers=headers, data=body) as r:
-            response = await r.text()
-            if not response or r.status > 200:
-                raise IOError(f"Could not communicate with MFC at '{endpoint}'.")
-            return response
+        headers = _XML_HEADERS if endpoint == 'ToolWeb/Cmd' else _FORM_HEADERS
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.session.request(method, url, headers=headers, data=body,
+                                                timeout=self.Timeout) as r:
+                    response = await (r.read() if raw else r.text())
+                    break
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(min(0.5, 0.05 * 2 ** attempt) + random.uniform(0, 0.01))
+        if r.status in (401, 403):
+            self._last_login = None
+        if not response or r.status > 200:
+            raise IOError(f"Could not communicate with MFC at '{endpoint}'.")
+        return response
+
+
+async def poll_all(addresses, timeout: float = 1.0, password: str = 'config',
+                   retries: int = 2):
+    """Retrieve the state of several devices concurrently.
+
+    All controllers share a single HTTP session, so the total time is set by
+    the slowest device rather than the sum of all of them. A device that
+    can't be read doesn't affect the others; its entry is replaced by
+    `{'error': message}`.
+
+    Args:
+        addresses: An iterable of device IP addresses, as strings.
+        timeout (optional): Time to wait for each attempt at a response.
+            Default 1s.
+        retries (optional): Number of times each request is retried after a
+            connection error or timeout. Default 2.
+        password (optional): Password used to access admin settings on the
+            web interface. Default "config".
+
+    Returns:
+        A dictionary of device states or error entries, keyed by address.
+
+    """
+    addresses = list(addresses)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector,
+                                     headers={'Connection': 'keep-alive'}) as session:
+        controllers = [FlowController(address, timeout, password, session, retries=retries)
+                       for address in addresses]
+        states = await asyncio.gather(*(fc.get() for fc in controllers),
+                                      return_exceptions=True)
+    results = {}
+    for address, state in zip(addresses, states):
+        if isinstance(state, asyncio.TimeoutError):
+            state = {'error': 'Could not connect to device.'}
+        elif isinstance(state, Exception):
+            state = {'error': str(state) or type(state).__name__}
+        elif isinstance(state, BaseException):
+            raise state
+        results[address] = state
+    return results
@@ -18,6 +18,8 @@ setup(
         'console_scripts': [('mfc = mfc:command_line')]
     },
     install_requires=['aiohttp>=3.3'],
+    extras_require={'uvloop': ['uvloop>=0.18']},
+    python_requires='>=3.7',
     license='GPLv2',
     classifiers=[
         'License :: OSI Approved :: GNU General Public License v2 (GPLv2)',
@@ -25,8 +27,6 @@ setup(
         'Natural Language :: English',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
         'Programming Language :: Python :: 3.9',
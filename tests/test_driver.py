@@ -0,0 +1,161 @@
+"""Tests for the MKS flow controller driver, run against a fake device."""
+import asyncio
+import unittest
+from struct import pack
+from unittest import mock
+
+from mfc import FlowController, poll_all
+
+DEVICE_JS = b'device_html.selected_gas = "Instance 1: N2";\ndevice_html.full_scale_amount = 100;\n'
+GASLIST_JS = b'instancelist = new Array();\ninstancelist[0] = "1: N2";\n'
+LOGIN_PAGE = b'<form><input type="password" name="CONFIG_PASSWORD"></form>'
+ADMIN_ENDPOINTS = ('change_display_mode', 'device_html_selected_gas')
+
+
+class FakeResponse(object):
+    """A canned response, usable as `async with session.request(...) as r`."""
+
+    def __init__(self, body, delay=0):
+        self.status = 200
+        self.body = body
+        self.delay = delay
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *err):
+        pass
+
+    async def read(self):
+        await asyncio.sleep(self.delay)
+        return self.body
+
+    async def text(self):
+        return (await self.read()).decode()
+
+
+class FakeDevice(object):
+    """Stand-in for an aiohttp session talking to one MFC's web interface."""
+
+    def __init__(self, setpoint=0.0, analog=False, poll_delay=0):
+        self.setpoint = setpoint
+        self.analog = analog
+        self.poll_delay = poll_delay
+        self.logged_in = False
+        self.display = None
+        self.requests = []
+
+    def request(self, method, url, headers=None, data=None, timeout=None):
+        endpoint = url.split('/', 3)[3]
+        self.requests.append((method, endpoint, data))
+        if endpoint == 'ToolWeb/Cmd':
+            value = pack('>f', self.setpoint).hex()
+            body = ''.join(f'<V Name="EVID_{i}">0x{value}</V>' for i in (0, 1, 3))
+            return FakeResponse(body.encode(), self.poll_delay)
+        if endpoint == 'flow_setpoint_html' and data.startswith('iobuf.setpoint='):
+            self.setpoint = float(data.split('=')[1].split('&')[0])
+        elif endpoint == 'configure_html_check':
+            self.logged_in = True
+        elif endpoint in ADMIN_ENDPOINTS:
+            if not self.logged_in:
+                return FakeResponse(LOGIN_PAGE)
+            if endpoint == 'change_display_mode':
+                self.display = int(data.split('=')[1].split('&')[0])
+        return FakeResponse({
+            'mfc.js': b'mfc.sp_adc_enable = 1;' if self.analog else b'var mfc;',
+            'device_html.js': DEVICE_JS,
+            'gaslist.js': GASLIST_JS,
+        }.get(endpoint, b'<html>OK</html>'))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *err):
+        pass
+
+    def posts(self, endpoint):
+        """Return the bodies POSTed to an endpoint."""
+        return [data for method, e, data in self.requests
+                if method == 'POST' and e == endpoint]
+
+
+class TestPollAll(unittest.TestCase):
+    """Tests for reading several controllers at once."""
+
+    def test_poll_all_does_not_write_to_analog_devices(self):
+        """A read-only poll must not trigger analog reboot recovery."""
+        device = FakeDevice(setpoint=42.0, analog=True)
+        with mock.patch('mfc.driver.aiohttp.ClientSession', return_value=device), \
+                mock.patch('mfc.driver.aiohttp.TCPConnector'):
+            states = asyncio.run(poll_all(['192.168.1.200']))
+        self.assertEqual(states['192.168.1.200']['setpoint'], 42.0)
+        self.assertEqual(device.setpoint, 42.0)
+        self.assertEqual([e for method, e, _ in device.requests if method == 'POST'],
+                         ['ToolWeb/Cmd'])
+
+
+class TestGet(unittest.TestCase):
+    """Tests for request coalescing and caching in `get`."""
+
+    def test_concurrent_gets_share_one_request(self):
+        """Concurrent calls to `get` send a single poll."""
+        device = FakeDevice(setpoint=5.0, poll_delay=0.01)
+
+        async def run():
+            fc = FlowController('192.168.1.200', session=device)
+            await fc.connect()
+            return await asyncio.gather(*(fc.get() for _ in range(5)))
+
+        states = asyncio.run(run())
+        self.assertEqual(len(device.posts('ToolWeb/Cmd')), 1)
+        self.assertTrue(all(state['setpoint'] == 5.0 for state in states))
+
+    def test_get_after_set_is_not_stale(self):
+        """A poll in flight during `set` must not be served afterwards."""
+        device = FakeDevice(setpoint=0.0, poll_delay=0.05)
+
+        async def run():
+            fc = FlowController('192.168.1.200', session=device, cache_ttl=1.0)
+            await fc.connect()
+            stale = asyncio.ensure_future(fc.get())
+            await asyncio.sleep(0.01)
+            await fc.set(42)
+            await stale
+            return await fc.get()
+
+        self.assertEqual(asyncio.run(run())['setpoint'], 42.0)
+
+    def test_disconnect_clears_cache(self):
+        """A reading from a previous session is not reused after reconnecting."""
+        device = FakeDevice(setpoint=5.0)
+
+        async def run():
+            fc = FlowController('192.168.1.200', session=device, cache_ttl=10.0)
+            await fc.get()
+            await fc.disconnect()
+            device.setpoint = 7.0
+            return await fc.get()
+
+        self.assertEqual(asyncio.run(run())['setpoint'], 7.0)
+
+
+class TestLogin(unittest.TestCase):
+    """Tests for admin operations that require a login."""
+
+    def test_expired_login_is_renewed(self):
+        """An admin request answered with the login page logs in and retries."""
+        device = FakeDevice()
+
+        async def run():
+            fc = FlowController('192.168.1.200', session=device)
+            await fc.set_display('flow')
+            device.logged_in = False
+            await fc.set_display('temperature')
+
+        asyncio.run(run())
+        self.assertEqual(device.display, 2)
+        self.assertEqual(len(device.posts('configure_html_check')), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()